@@ -55,43 +55,400 @@ r"""``gitkv`` lets you use a git repo as a key-value store using
 'Your content.'
 """
 
+import errno
 import io
+import atexit
+import concurrent.futures
+import contextlib
 import logging
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 import importlib
+import fcntl
+import hashlib
+import itertools
 import os
+import random
+import shutil
+import stat
+import weakref
 import re
+import shlex
 
 logger = logging.getLogger('gitkv')
 logger.setLevel(level=logging.INFO)
 __version__ = '1.1.1'
+_MISSING = object()
+# The common stream methods, bound on File and FileInRepo instances so that
+# they never go through __getattr__
+STREAM_METHODS = ('read', 'write', 'readline', 'seek', 'tell')
+COMMIT_LINE = re.compile(r'^commit (\w+)', re.MULTILINE)
+# How many listings of trees Repo.items keeps
+TREE_CACHE_SIZE = 256
+SHM_DIR = '/dev/shm'
+# in_memory clones are only made in SHM_DIR if it has that much room left
+SHM_MIN_FREE = 256 * 2 ** 20
+# Do not take the optional locks that make concurrent commands wait on each
+# other (git may still ask for credentials, e.g. for https remotes)
+GIT_ENV = {'GIT_OPTIONAL_LOCKS': '0'}
+# Write the files of a checkout (clone, reset) from one worker per core.
+# git only does so above checkout.thresholdForParallelism (100) files
+PARALLEL_CHECKOUT = ['-c', 'checkout.workers=0']
+# Buffer size of the files opened for binary writing
+WRITE_BUFFER_SIZE = io.DEFAULT_BUFFER_SIZE * 8
+# A file modified less than that long (in ns) before being opened for
+# writing is committed when closed even if its stat looks unchanged: a
+# rewrite within one timestamp tick (2s on FAT) would not show ("racy git")
+RACY_WINDOW = 2 * 10 ** 9
+# Clones kept across Repo instances and processes, see Repo.acquire_slot
+# Name of the file, in the git directory, telling that a pooled clone was
+# given back clean, see Repo.close
+CLEAN_MARK = 'gitkv-clean'
+POOL_DIR_NAME = 'gitkv-pool-{}'.format(os.getuid())
+# Pooled clones not used for that many seconds are removed, see clear_pool
+POOL_TTL = 24 * 3600
+# How often, at most, Repo.close looks for such clones, in seconds
+POOL_SWEEP_INTERVAL = 600
+# The pushes of the Repo made with background_push=True run in these threads,
+# which the interpreter waits for before exiting
+PUSH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix='gitkv-push')
+# How many times remote_sync tries to push when the remote keeps moving on,
+# and the base of its exponential backoff between attempts, in seconds.
+# About a dozen concurrent writers of one remote all get through, more may
+# get a PushError
+PUSH_ATTEMPTS = 8
+PUSH_BACKOFF = 0.05
+# Per (pid, branch, parent directory), the directory of the repos Repo()
+# copies, see blank_repos
+_blank_repos = {}
+_blank_repos_lock = threading.Lock()
+# When this process last ran sweep_pool, see time.monotonic
+_last_pool_sweep = None
+
+
+def is_read_only(mode):
+    '''Return True if ``mode``, as given to ``open``, does not allow writing'''
+    return not set(mode) & set('wax+')
+
+
+def is_local_repo(url):
+    '''Return True if url is the path of a local (bare or not) git repo'''
+    return url is not None and (os.path.isfile(os.path.join(url, 'HEAD')) or
+                                os.path.exists(os.path.join(url, '.git')))
+
+
+def local_git_dir(url):
+    '''Return the git directory of the local repo at url'''
+    return url if os.path.isfile(os.path.join(url, 'HEAD')) \
+        else os.path.join(url, '.git')
+
+
+def tmp_dir_parent(in_memory=False):
+    '''Return where Repo should make its clones, None for the default
+    temporary directory, see :py:func:`Repo.__init__`'''
+    if os.environ.get('GITKV_TMPDIR'):
+        return os.environ['GITKV_TMPDIR']
+    if not in_memory or not os.access(SHM_DIR, os.W_OK):
+        return None
+    stat = os.statvfs(SHM_DIR)
+    return SHM_DIR if stat.f_bavail * stat.f_frsize >= SHM_MIN_FREE else None
+
+
+def pool_dir(parent, create=True):
+    '''Return the directory of the pooled clones in parent, None if it can
+    not be used.
+
+    parent (e.g. ``/tmp``) may be writable by anyone, so the directory is
+    only used if it is a real directory of ours that nobody else can get
+    into: one made by someone else could let them read or change our
+    clones.
+
+    :param create: if True, the directory is made when there is none'''
+    path = os.path.join(parent, POOL_DIR_NAME)
+    if create:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+            or stat.S_IMODE(st.st_mode) & 0o077:
+        logger.warning('Not using %s: it is not a private directory of ours',
+                       path)
+        return None
+    return path
+
+
+def lock_file(path, create=True):
+    '''Return a file descriptor of the file at path, locked with ``flock``,
+    None if someone else holds the lock or there is no such file.
+
+    :param create: if True, the file is made when there is none
+
+    :py:func:`clear_pool` removes lock files while holding their lock:
+    whoever opened one before then locks a removed file, so we check that
+    the file we locked is still the one at path.'''
+    while True:
+        try:
+            fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0),
+                         0o600)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked, current = os.fstat(fd), os.stat(path)
+            if (locked.st_dev, locked.st_ino) == \
+                    (current.st_dev, current.st_ino):
+                return fd
+        except BlockingIOError:  # In use
+            os.close(fd)
+            return None
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def clear_pool(max_age=None):
+    '''Remove the pooled clones no Repo is using, and their lock files, see
+    :py:func:`Repo.acquire_slot`.
+
+    :param max_age: int, optional, only remove the clones that were last
+        used more than this many seconds ago, or whose remote is a local
+        path that does not exist any more
+
+    This is done with ``max_age=POOL_TTL`` whenever a Repo has to make a new
+    clone in the pool, and from time to time when one is closed, see
+    :py:func:`sweep_pool`.
+
+    >>> import gitkv
+    >>> remote = gitkv.Repo()
+    >>> repo = gitkv.Repo(remote.url)
+    >>> repo.close()
+    >>> os.path.isdir(repo.path)
+    True
+    >>> gitkv.clear_pool()
+    >>> os.path.isdir(repo.path)
+    False
+    '''
+    now = time.time()
+    parents = {tempfile.gettempdir(), SHM_DIR, tmp_dir_parent()} - {None}
+    for pool in (pool_dir(p, create=False) for p in parents):
+        if pool is None:
+            continue
+        for name in os.listdir(pool):
+            if not name.endswith('.lock'):
+                continue
+            slot = os.path.join(pool, name[:-len('.lock')])
+            fd = lock_file(slot + '.lock', create=False)
+            if fd is None:
+                continue
+            try:
+                # The url of the remote, see Repo.acquire_slot
+                url = os.read(fd, 4096).decode('utf-8', 'replace')
+                path = url[len('file://'):] if url.startswith('file://') \
+                    else url
+                if max_age is None \
+                        or now - os.fstat(fd).st_mtime > max_age \
+                        or os.path.isabs(path) and not os.path.exists(path):
+                    shutil.rmtree(slot, ignore_errors=True)
+                    os.remove(slot + '.lock')
+            finally:
+                os.close(fd)
+
+
+def sweep_pool():
+    '''Call ``clear_pool(POOL_TTL)``, unless this process did so less than
+    ``POOL_SWEEP_INTERVAL`` seconds ago.'''
+    global _last_pool_sweep
+    now = time.monotonic()
+    if _last_pool_sweep is not None \
+            and now - _last_pool_sweep < POOL_SWEEP_INTERVAL:
+        return
+    _last_pool_sweep = now
+    clear_pool(POOL_TTL)
+
+
+def is_rejected_push(output):
+    '''Return True if the output of ``git push --porcelain`` tells that the
+    remote moved on (as opposed to e.g. a hook refusing the push)'''
+    return any(line.startswith('!\t') and '\t[rejected]' in line
+               for line in output.split('\n'))
+
+
+def is_failed_ref_update(output):
+    '''Return True if the output of ``git push --porcelain`` tells that the
+    remote could not update its ref: a concurrent push may have locked it,
+    but so may e.g. permissions or a full disk'''
+    return any(line.startswith('!\t') and
+               line.endswith('\t[remote rejected] (failed to update ref)')
+               for line in output.split('\n'))
+
+
+def read_ref(git_dir, ref):
+    '''Return the id a full ref name (e.g. ``refs/heads/master``) points to
+    in git_dir, None if there is none, without spawning git.'''
+    try:
+        with io.open(os.path.join(git_dir, ref)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    try:
+        with io.open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split(' ')[0]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def log_push_error(future):
+    '''Log the error of a background push, which nobody may ask for'''
+    if future.exception() is not None:
+        logger.error('Background push failed: %s', future.exception())
+
+
+def stop_process(process):
+    '''Close the stdin of a process we talk to, and wait for its end'''
+    try:
+        process.stdin.close()
+    except BrokenPipeError:  # It is already gone
+        pass
+    process.wait()
+
+
+class GitCmdError(RuntimeError):
+    """Raised by :py:func:`run_cmd` when a command fails."""
+
+    def __init__(self, cmd, returncode, output):
+        """Keep the failed command, its return code and its output."""
+        self.cmd = cmd
+        self.returncode = returncode
+        self.output = output.decode('utf-8', 'replace')
+        super().__init__('{}\n{}'.format(' '.join(cmd), self.output))
 
 
-def run_cmd(cmd, **kwargs):
-    '''Run a command, log it, raise on error, return the output.'''
+def run_cmd(cmd, binary=False, **kwargs):
+    '''Run a command, log it, raise on error, return the output.
+
+    The output is decoded from UTF-8, unless ``binary`` is True.
+
+    Unless told otherwise, the command runs with ``GIT_ENV`` added to our
+    environment, and without the (useless, as our fds are not inheritable)
+    closing of all file descriptors in the child.'''
+    kwargs.setdefault('env', dict(os.environ, **GIT_ENV))
+    kwargs.setdefault('close_fds', False)
     try:
         output = subprocess.check_output(cmd, stderr=subprocess.STDOUT,
-                                         **kwargs).decode('utf-8')
-        logger.debug('{}\n\t{}'.format(' '.join(cmd),
-                                       '\n\t'.join(output.split('\n'))))
+                                         **kwargs)
+        if binary:
+            logger.debug('%s\n\t%s bytes', ' '.join(cmd), len(output))
+            return output
+        output = output.decode('utf-8')
+        # Do not build the (maybe large) message if it will not be emitted
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s\n\t%s', ' '.join(cmd),
+                         '\n\t'.join(output.split('\n')))
         return output
     except subprocess.CalledProcessError as e:
-        raise RuntimeError('{}\n{}'.format(' '.join(cmd), e.output))
-
-
-class open:
+        raise GitCmdError(cmd, e.returncode, e.output) from None
+
+
+def run_cmds(*cmds, **kwargs):
+    '''Run commands one after the other in a single shell, stopping at the
+    first that fails, see :py:func:`run_cmd`.
+
+    This spawns one process from Python instead of one per command. Each
+    command is a list of arguments, or a string of shell code.'''
+    script = ' && '.join(c if isinstance(c, str) else shlex.join(c)
+                         for c in cmds)
+    return run_cmd(['sh', '-c', script], **kwargs)
+
+
+def commit_cmd(message):
+    '''Return the shell code of a ``git commit`` for :py:func:`run_cmds`.
+
+    It does not fail when there is nothing to commit (git then exits with
+    1, real errors exit with 128).'''
+    return '{{ {} || test $? = 1; }}'.format(
+        shlex.join(['git', 'commit', '-m', message]))
+
+
+def init_repo(path, branch, bare_clone=None, object_format='sha1'):
+    '''Make a repo in the existing directory path, with an initial commit of
+    an empty ``.gitignore`` on branch, and a bare clone of it at
+    ``bare_clone`` if given, with a single shell.
+
+    The sample hooks are not copied in, they are never used.'''
+    with io.open(os.path.join(path, '.gitignore'), 'w') as f:
+        f.write('\n')
+    cmds = [['git', 'init', '--quiet', '--template=',
+             '--initial-branch=' + branch,
+             '--object-format=' + object_format],
+            ['git', 'add', '.gitignore'],
+            commit_cmd('GitKV: initial commit')]
+    if bare_clone:
+        cmds += [['git', 'clone', '--quiet', '--template=', '--bare',
+                  '--no-tags', '.', bare_clone],
+                 # Its origin would be us, which may be gone (or a template)
+                 ['git', '-C', bare_clone, 'remote', 'remove', 'origin']]
+    run_cmds(*cmds, cwd=path)
+
+
+def blank_repos(branch, parent=None):
+    '''Return the directory of a bare ``remote/`` repo and of its
+    ``clone/``, at the same initial commit on branch.
+
+    They are made once per process, in parent (the default temporary
+    directory if None), which should be on the same filesystem as their
+    copies: copying them is faster than running git for each ``Repo()``.'''
+    key = (os.getpid(), branch, parent)
+    with _blank_repos_lock:
+        if key not in _blank_repos:
+            path = tempfile.mkdtemp(prefix='gitkv-blank-', dir=parent)
+            clone = os.path.join(path, 'clone')
+            os.mkdir(clone)
+            init_repo(clone, branch, os.path.join(path, 'remote'))
+            _blank_repos[key] = path
+        return _blank_repos[key]
+
+
+@atexit.register
+def remove_blank_repos():
+    '''Remove the blank_repos made by this process.
+
+    Those of our parent, before a fork, are still in use by it.'''
+    for (pid, _, _), path in list(_blank_repos.items()):
+        if pid == os.getpid():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class File:
     """Open a file in a repository.
 
-    It is usually instanciated as a context manager.
+    It is usually instanciated, under its ``gitkv.open`` alias, as a context
+    manager.
 
-    This method clones the repo in a local temporary directory.
+    This method clones the repo in a local directory, or reuses a previous
+    clone of the same url, see :py:class:`Repo`.
 
     When ``close()`` is called on the returned object (e.g. when one exits from
     the with block), an automatic commit is added to our clone, and is then
     pushed to the repo at ``url``.
+
+    A file opened for reading only in a local repo is read straight from
+    the repo's HEAD, without cloning, committing or pushing anything.
     """
 
+    __slots__ = ('filename', 'repo', 'fir') + STREAM_METHODS
+
     def __enter__(self):
         """Enter a ``with`` block"""
         return self
@@ -108,9 +465,18 @@ class open:
                 'true' ``open`` function
             :return: a stream-like object"""
         self.filename = filename
-        self.repo = Repo(url)
+        mode = args[0] if args else kwargs.get('mode', 'r')
+        if is_read_only(mode) and is_local_repo(url):
+            self.repo = ReadOnlyRepo(url)
+        else:
+            self.repo = Repo(url)
         self.repo.commit_message = "GitKV: " + self.filename
         self.fir = self.repo.open(filename, *args, **kwargs)
+        # Same as FileInRepo, spare the common calls our __getattr__ (unless
+        # our FileInRepo will only open its stream when first used)
+        if self.fir.fd is not None:
+            for name in STREAM_METHODS:
+                setattr(self, name, getattr(self.fir, name))
 
     def __iter__(self):
         """Explicitely delegate __iter__ to our fir.
@@ -122,27 +488,103 @@ class open:
 
     def __getattr__(self, item):
         """Pass unknown attribute requests down to our FileInRepo instance"""
-        return self.fir.__getattr__(item)
+        return getattr(self.fir, item)
 
     def close(self):
         """Close our FileInRepo instance and our Repo instance.
 
-        see :py:func:`Repo.close` and :py:func:`FileInRepo.close`"""
+        see :py:func:`Repo.sync_and_close` and :py:func:`FileInRepo.close`
+        """
         self.fir.close()
-        self.repo.remote_sync()
+        self.repo.sync_and_close()
+
+    def abort(self):
+        """Close our FileInRepo instance and our Repo instance, without
+        committing nor pushing anything.
+
+        see :py:func:`Repo.abort` and :py:func:`FileInRepo.abort`"""
+        self.fir.abort()
+        self.repo.abort()
 
     def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
         """"Exit a ``with`` block."""
         self.close()
 
 
+# The historical, open()-like name of File
+open = File
+
+
+def open_many(specs, max_workers=8):
+    '''Open several files at once, return the list of their
+    :py:class:`File`, in the order of ``specs``.
+
+    The repositories are cloned in parallel, from threads that wait on git.
+
+    :param specs: iterable of the argument tuples of :py:class:`File`,
+        e.g. ``(url, filename, 'w')``
+    :param max_workers: how many files are opened at the same time
+
+    If a file can not be opened, the others are closed without committing
+    anything, and its error is raised.
+
+    >>> import gitkv
+    >>> repo = gitkv.Repo()
+    >>> files = gitkv.open_many([(repo.url, 'a', 'w'), (repo.url, 'b', 'w')])
+    >>> for f in files:
+    ...     f.write('Some content')
+    ...     f.close()
+    12
+    12
+    >>> with gitkv.Repo(repo.url) as other:
+    ...     sorted(other)
+    ['.gitignore', 'a', 'b']
+
+    When one of them fails, the files already opened (and truncated) are
+    not committed, and their clones are reset before being used again:
+
+    >>> gitkv.open_many([(repo.url, 'a', 'w'), (repo.url, 'nofile', 'r')])
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    FileNotFoundError: nofile
+    >>> with gitkv.Repo(repo.url) as other:
+    ...     other.open('a').read()
+    'Some content'
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(File, *spec) for spec in specs]
+    files = [f.result() for f in futures if f.exception() is None]
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        for f in files:
+            f.abort()
+        raise errors[0]
+    return files
+
+
 class Repo:
     """A git repository.
 
     It is usually instanciated as a context manager.
 
     The provided repo is cloned. Upon the exiting the context, a commit is
-    created and pushed to the original repo.
+    created and pushed to the original repo. All the files changed during
+    the context go in this one commit, which is skipped if nothing changed:
+    those written through gitkv (files opened for writing, or module calls
+    such as ``repo.os.remove(...)``), and those ``git status`` finds changed
+    by other means (e.g. the builtin ``open`` on ``repo.path + name``, or a
+    stream never closed). A file still open for writing is left out, with a
+    warning in the log.
+
+    Clones are pooled on disk: once a ``Repo`` is closed, its clone is
+    reused by the next ``Repo`` of the same url (in this process or in
+    another one), which fetches and resets it instead of cloning again.
+    Exiting the ``with`` block does not close the ``Repo``, which can still
+    be read afterwards: call :py:func:`Repo.close` to give its clone back
+    earlier than when it is garbage collected.
+    When the pool's directory can not be trusted (see :py:func:`pool_dir`),
+    each ``Repo`` makes a temporary clone instead.
 
     An PushError exception will be raised when gitkv can't push on the
     remote because of a conflict.
@@ -177,28 +619,52 @@ class Repo:
         return self
 
     def is_empty(self):
-        '''Return True self is an empty repo'''
-        try:
-            run_cmd(['git', 'rev-list', 'HEAD'], cwd=self.path)
-        except RuntimeError:  # Will fail if HEAD does not exist, i.e.
-            return True  # if the repo is empty
-        return False
+        '''Return True self is an empty repo
+
+        HEAD is read in the git directory, instead of asking git to list
+        the whole history.'''
+        return self.head_id() is None
 
     def initial_commit_if_empty(self):
         '''Commit an empty .gitignore file if the given repo is empty'''
         if not self.is_empty():
             return
-        with self.open('.gitignore', 'w') as f:
+        self.initial_commit()
+
+    def initial_commit(self):
+        '''Commit an empty .gitignore file'''
+        with io.open(self.path + '.gitignore', 'w') as f:
             f.write('\n')
+        self._dirty.add('.gitignore')
         self.git_commit("GitKV: initial commit")
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, in_memory=False, commit_per_file=False,
+                 shallow=True, fresh=False, background_push=False):
         """Return the context manager.
 
         :param url: git repository where you want to open a file.
             It can be anything that is accepted by git, such as a relative
             or absolute path, a http or https url, or a ``user@host:repo``
             type url, etc.
+        :param in_memory: if True, the clone is made in ``/dev/shm``
+            (when it exists, is writable and has 256 MiB free), so that
+            reading files and walking the history hit RAM instead of the
+            disk. Useful for read-heavy workloads. The ``GITKV_TMPDIR``
+            environment variable, when set, is used in any case instead.
+        :param commit_per_file: if True, each file opened for writing is
+            committed on its own when it is closed, instead of being part of
+            the commit created when the context exits.
+        :param shallow: if True, only the last commit is cloned (git ignores
+            this for local paths, use a ``file://`` url to make it apply).
+            In any case, only the remote's default branch is cloned.
+            The rest of the history is fetched the first time it is needed,
+            see :py:func:`Repo.ensure_full_history`.
+        :param fresh: if True, the pool is not used, a new clone is made in a
+            temporary directory.
+        :param background_push: if True, exiting the ``with`` block does not
+            wait for the commit and push: they are made in a background
+            thread, see :py:func:`Repo.__exit__`. Their errors are only
+            logged, unless ``push_future.result()`` is called.
 
         If ``url`` is a directory with a non bare git repo in it, please
         configure your git repository beforehand:
@@ -212,22 +678,270 @@ class Repo:
         If ``url`` is None, an empty git repository is created in a
         temporary directory.
         """
-        self.url = url
+        self.init_state(url, commit_per_file, background_push)
+        tmp_parent = tmp_dir_parent(in_memory)
         if self.url is None:
-            self.tmp_repo_dir = tempfile.TemporaryDirectory()
-            self.url = self.tmp_repo_dir.name + '/'
-            logger.info('Initialazing a temporary empty git repo: '
-                        + self.url)
-            self.git_init(self.url, bare=True)
-
-        self.tmp_dir = tempfile.TemporaryDirectory()
-        self.path = self.tmp_dir.name + '/'
-        self.branch = 'master'
-        self.git_clone(self.url, self.path)
-        self.initial_commit_if_empty()
+            # A single temporary directory holds the remote and our clone
+            self.tmp_repo_dir = tempfile.TemporaryDirectory(dir=tmp_parent)
+            self.url = os.path.join(self.tmp_repo_dir.name, 'remote', '')
+            logger.info('Initialazing a temporary empty git repo: %s',
+                        self.url)
+
+        pool = None if url is None or fresh \
+            else pool_dir(tmp_parent or tempfile.gettempdir())
         if url is None:
-            self.git_push()
+            clone_dir = os.path.join(self.tmp_repo_dir.name, 'clone')
+            os.mkdir(clone_dir)
+        elif pool is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(dir=tmp_parent)
+            clone_dir = self.tmp_dir.name
+        else:
+            clone_dir = self.acquire_slot(pool)
+        # With its trailing separator, self.path + filename is a valid path
+        self.path = os.path.join(clone_dir, '')
+        self.git_dir = self.path + '.git' + os.sep
+        if url is None:
+            self.init_with_bare_remote()
+            return
+        if self.tmp_dir is None:
+            if self.reset_to_remote():
+                return  # A non empty clone, as up to date as a new one
+            # We are about to clone anyway, the time to drop old clones
+            clear_pool(POOL_TTL)
+        if self.remote_is_empty():
+            # Cloning would only give us an empty repo, with more spawns
+            os.makedirs(self.path, exist_ok=True)
+            self.init_with_bare_remote(make_remote=False)
+            return
+        # Only the branch we work on, whether shallow or not
+        self.git_clone(self.url, self.path, '--single-branch', '--no-tags',
+                       *(['--depth=1'] if shallow else []))
+        self.synced_head = self.head_id()
+        self.initial_commit_if_empty()
+
+    def init_state(self, url, commit_per_file=False, background_push=False):
+        """Set the attributes of a Repo that are not about where its clone
+        is, see :py:func:`Repo.__init__`.
+
+        :py:class:`ReadOnlyRepo` calls it too: an attribute left unset would
+        be looked up by :py:func:`Repo.__getattr__` as a module."""
+        self._module_cache = {}
+        # Names of the files written since the last commit, '.' if unknown
+        self._dirty = set()
+        # Held by the methods that change the clone or the remote, so that
+        # threads sharing a Repo do not run git on top of each other
+        self.lock = threading.RLock()
+        self.commit_per_file = commit_per_file
+        # The FileInRepo opened for writing and not closed yet
+        self._writers = weakref.WeakSet()
+        # The files of the batch() in progress, in each thread
+        self._batch = threading.local()
+        self.background_push = background_push
+        self.push_future = None
+        self.url = url
+        self.tmp_repo_dir = None
+        self.tmp_dir = None
+        self.release_slot = None
+        self._log_cache = {}
+        self._tree_cache = {}
+        self._id_size = None
+        self._cat_file = None
+        self.branch = 'master'
         self.commit_message = 'GitKV'
+        # The HEAD the remote branch was at when we last fetched or pushed
+        self.synced_head = None
+        # False once a wrapped call may have left e.g. untracked files
+        self._pristine = True
+
+    def init_with_bare_remote(self, make_remote=True):
+        """Make our repo, with its initial commit, and its bare remote.
+
+        Instead of initializing the bare repo, cloning it, committing and
+        pushing, both are copied from :py:func:`blank_repos`. The remote is
+        then set as our ``origin`` by writing our git config, which spares a
+        ``git remote add``.
+
+        :param make_remote: if False, the remote already exists (and is
+            empty), our repo is made with :py:func:`init_repo`, and our
+            initial commit is pushed by :py:func:`Repo.remote_sync`."""
+        if make_remote:
+            # Made next to our temporary directory, in the same filesystem
+            blank = blank_repos(self.branch,
+                                os.path.dirname(self.tmp_repo_dir.name))
+            shutil.copytree(blank, self.tmp_repo_dir.name, symlinks=True,
+                            dirs_exist_ok=True)
+        else:
+            # The remote will only accept ids of its own kind
+            object_format = run_cmd(['git', 'rev-parse',
+                                     '--show-object-format'],
+                                    cwd=local_git_dir(self.url)).strip()
+            init_repo(self.path, self.branch, object_format=object_format)
+        # git clone would store the path of a local remote as absolute: our
+        # git does not run from the directory the url is relative to
+        url = os.path.abspath(self.url) if is_local_repo(self.url) \
+            else self.url
+        url = url.replace('\\', '\\\\').replace('"', '\\"')
+        with io.open(self.git_dir + 'config', 'a') as f:
+            f.write('[remote "origin"]\n\turl = "{}"\n'
+                    '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+                    .format(url))
+        if make_remote:
+            self.synced_head = self.head_id()
+
+    def remote_is_empty(self):
+        """Return True if the remote is a local repo with no commit to clone.
+
+        That is, neither its HEAD nor our branch point to a commit."""
+        if not is_local_repo(self.url):
+            return False
+        git_dir = local_git_dir(self.url)
+        try:
+            with io.open(os.path.join(git_dir, 'HEAD')) as f:
+                head = f.read().strip()
+        except OSError:
+            return False
+        return head.startswith('ref: ') \
+            and read_ref(git_dir, head[len('ref: '):]) is None \
+            and self.remote_head() is None
+
+    def acquire_slot(self, pool):
+        """Lock the first free slot for our url in the pool directory, see
+        :py:func:`pool_dir`, return its path.
+
+        Slots are locked with ``flock``, so that two ``Repo`` never share a
+        clone, whatever the thread or process they are in. The lock is
+        released by :py:func:`Repo.close`, or when we are garbage collected.
+        """
+        url = os.path.abspath(self.url) if os.path.isdir(self.url) \
+            else self.url
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        for n in itertools.count():
+            slot = os.path.join(pool, '{}-{}'.format(key, n))
+            fd = lock_file(slot + '.lock')
+            if fd is None:
+                continue
+            # For clear_pool: our remote, and when the slot was last used
+            # (the time of this write)
+            os.ftruncate(fd, 0)
+            os.write(fd, url.encode('utf-8'))
+            self.release_slot = weakref.finalize(self, os.close, fd)
+            logger.debug('Using pool slot %s', slot)
+            return slot
+
+    def reset_to_remote(self):
+        """Bring a pooled clone to the state of the remote branch.
+
+        Return False, after removing the clone if there was one, when this
+        can not be done (no clone yet, unreachable or empty remote...)."""
+        if not os.path.isdir(self.git_dir):
+            shutil.rmtree(self.path, ignore_errors=True)
+            return False
+        # Left by close() when the clone was at that commit with nothing
+        # else in it. Removed, as we may now change the clone
+        try:
+            with io.open(self.git_dir + CLEAN_MARK) as f:
+                clean_head = f.read()
+            os.remove(self.git_dir + CLEAN_MARK)
+        except FileNotFoundError:
+            clean_head = None
+        try:
+            if clean_head is not None and clean_head == self.remote_head():
+                self.synced_head = clean_head
+                return True
+            self.refresh()
+        except GitCmdError as e:
+            logger.info('Can not reuse %s: %s', self.path, e)
+            shutil.rmtree(self.path)
+            return False
+        return True
+
+    def refresh(self):
+        """Bring our clone to the current state of the remote branch.
+
+        This only fetches what is new, which is much cheaper than a new
+        ``Repo``. Whatever was not pushed yet is lost: call
+        :py:func:`remote_sync` first to keep it.
+
+        >>> import gitkv
+        >>> remote = gitkv.Repo()
+        >>> repo = gitkv.Repo(remote.url)
+        >>> with gitkv.open(remote.url, 'afile', 'w') as f:
+        ...     f.write('Some content')
+        12
+        >>> repo.list_files()
+        ['.gitignore']
+        >>> repo.refresh()
+        >>> repo.list_files()
+        ['.gitignore', 'afile']
+        """
+        with self.lock:
+            run_cmd(['git', 'fetch', '--no-tags', 'origin', self.branch],
+                    cwd=self.path)
+            run_cmd(['git'] + PARALLEL_CHECKOUT + ['reset', '--hard',
+                                                   'FETCH_HEAD'],
+                    cwd=self.path)
+            run_cmd(['git', 'clean', '-ffdx'], cwd=self.path)
+            self._dirty.clear()
+            self._pristine = True
+            self.synced_head = self.head_id()
+
+    def close(self):
+        """Give our clone back to the pool (or delete a temporary one).
+
+        The Repo must not be used afterwards. This is done when the Repo is
+        garbage collected if it was not called, but exiting a ``with`` block
+        does not call it."""
+        if self._cat_file is not None:
+            self._cat_file[1]()
+            self._cat_file = None
+        if self.release_slot is not None:
+            head = self.head_id()
+            if self._pristine and not self._dirty \
+                    and head is not None and head == self.synced_head \
+                    and self.is_clean():
+                # The next user of the slot can skip resetting it
+                with io.open(self.git_dir + CLEAN_MARK, 'w') as f:
+                    f.write(head)
+            self.release_slot()
+            sweep_pool()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+        elif self.tmp_repo_dir is not None:
+            # The remote stays until we are garbage collected, so that it
+            # can still be cloned
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def is_clean(self):
+        """Return True if our working tree and index match HEAD, with no
+        untracked nor ignored file.
+
+        Files may be changed behind our back (e.g. a stream never closed,
+        or written with the builtin ``open``), so this asks git."""
+        try:
+            return run_cmd(['git', 'status', '--porcelain', '--ignored',
+                            '--untracked-files=all'], cwd=self.path) == ''
+        except GitCmdError:
+            return False
+
+    def changed_files(self):
+        """Return the set of the paths ``git status`` finds changed in our
+        working tree, untracked files included.
+
+        Files may be changed without going through gitkv, see
+        :py:class:`Repo`."""
+        output = run_cmd(['git', 'status', '--porcelain', '-z', '--no-renames',
+                          '--untracked-files=all'], cwd=self.path)
+        # Entries of 'XY <path>'
+        return {entry[3:] for entry in output.split('\0') if entry}
+
+    def abort(self):
+        """Close the Repo without committing nor pushing anything.
+
+        What was changed in our clone is dropped: a pooled clone is not
+        given back as clean, so its next user resets it."""
+        self._dirty.clear()
+        self._pristine = False
+        self.close()
 
     def open(self, filename, *args, **kwargs):
         """Open a file in this Repo
@@ -237,41 +951,275 @@ class Repo:
             to the 'true' ``open`` function.
         :return: a stream-like object
         """
-        logger.debug('Opening file ' + filename)
+        logger.debug('Opening file %s', filename)
         return FileInRepo(filename, self, *args, **kwargs)
 
+    @contextlib.contextmanager
+    def batch(self, message=None):
+        """Commit the files written in a ``with`` block all at once.
+
+        Files closed in the block, by this thread, are not committed on their
+        own, even with ``commit_per_file``. A single commit of them is made
+        when the block exits without error (otherwise they are left to
+        :py:func:`Repo.remote_sync`). It is pushed, as usual, by
+        :py:func:`Repo.remote_sync`. Other threads are not affected, and a
+        nested block is part of the outermost one.
+
+        :param message: the commit message, see :py:func:`batch_message`
+            for the default one.
+
+        >>> import gitkv
+        >>> with gitkv.Repo(commit_per_file=True) as repo:
+        ...     with repo.batch('Two files'):
+        ...         for name in ('a', 'b'):
+        ...             with repo.open(name, 'w') as f:
+        ...                 f.write(name)
+        ...     repo.message().strip(), len(repo.git_log())
+        1
+        1
+        ('Two files', 2)
+        """
+        if getattr(self._batch, 'files', None) is not None:
+            yield self  # The outermost block commits
+            return
+        files = self._batch.files = set()
+        try:
+            yield self
+        except BaseException:
+            with self.lock:
+                self._dirty.update(files)
+            raise
+        finally:
+            self._batch.files = None
+        if files:
+            self.git_commit(message if message is not None
+                            else self.batch_message(files), files)
+
     def __getattr__(self, item):
         """Call e.g. ``self.m.f(a, b, c)`` as ``self.m.f(self.path+a, b, c)``.
 
-        Import all modules between self and f."""
-        logger.debug("Repo getattr: " + item)
+        Import all modules between self and f. The wrapper is cached, so
+        that ``m`` is only imported once per instance."""
+        try:
+            return self._module_cache[item]
+        except KeyError:
+            pass
+        logger.debug("Repo getattr: %s", item)
 
         def prepend_path_to_first_arg(*args):
+            self._dirty.add('.')  # Can't know what the call will change
+            self._pristine = False
             return [self.path + args[0]] + list(args[1:])
 
-        return ModuleWrapper(item, prepend_path_to_first_arg)
+        wrapper = ModuleWrapper(item, prepend_path_to_first_arg)
+        self._module_cache[item] = wrapper
+        return wrapper
+
+    def cat_object(self, rev, object_type):
+        """Return the content, as bytes, of the object ``rev`` (e.g.
+        ``HEAD:afile``), which must be of the given type.
+
+        All the calls of a Repo are answered by the same
+        ``git cat-file --batch`` process, instead of spawning one git per
+        object. It is stopped by :py:func:`Repo.close`.
+
+        :raise GitCmdError: if there is no such object."""
+        with self.lock:
+            if self._cat_file is None:
+                process = subprocess.Popen(
+                    ['git', 'cat-file', '--batch'], cwd=self.path,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    env=dict(os.environ, **GIT_ENV), close_fds=False)
+                self._cat_file = (process,
+                                  weakref.finalize(self, stop_process,
+                                                   process))
+            process = self._cat_file[0]
+            try:
+                process.stdin.write(rev.encode('utf-8') + b'\n')
+                process.stdin.flush()
+                # '<id> <type> <size>\n<content>\n', or '<rev> missing\n'
+                header = process.stdout.readline()
+            except BrokenPipeError:
+                header = b''
+            fields = header.split()
+            if not header:  # The process died, start a new one next time
+                self._cat_file[1]()
+                self._cat_file = None
+            if len(fields) != 3:
+                raise GitCmdError(['git', 'cat-file', object_type, rev], 128,
+                                  header)
+            data = process.stdout.read(int(fields[2]) + 1)[:-1]
+        if fields[1].decode() != object_type:
+            raise GitCmdError(['git', 'cat-file', object_type, rev], 128,
+                              header)
+        return data
+
+    def cat_blob(self, rev):
+        """Return the content, as bytes, of the blob ``rev``, see
+        :py:func:`Repo.cat_object`."""
+        return self.cat_object(rev, 'blob')
+
+    def items(self, id_commit='HEAD', recursive=False):
+        """Yield the (name, object id) of all files in repo in a commit,
+        or in a directory of a commit given as e.g. ``HEAD:dir``.
+
+        :param recursive: if True, the files in subdirectories are listed
+            too (as ``dir/file``), instead of the subdirectories themselves.
+
+        The objects are read from :py:func:`Repo.cat_object`, and the
+        listings are cached by tree id: commits sharing a tree (or iterating
+        over the repo again) do not parse it again.
 
-    def list_files(self, id_commit='HEAD'):
-        """List all files in repo in a commit."""
-        return run_cmd(['git', 'ls-tree', '--name-only', id_commit],
-                       cwd=self.path).split('\n')
+        >>> import gitkv
+        >>> with gitkv.Repo() as repo:
+        ...     repo.os.makedirs('dir')
+        ...     with repo.open('dir/afile', 'w') as f:
+        ...         f.write('Some content')
+        12
+        >>> [name for name, _ in repo.items()]
+        ['.gitignore', 'dir']
+        >>> files = dict(repo.items(recursive=True))
+        >>> sorted(files)
+        ['.gitignore', 'dir/afile']
+        >>> repo.cat_blob(files['dir/afile'])
+        b'Some content'
+        >>> repo.list_files(recursive=True)
+        ['.gitignore', 'dir/afile']
+        """
+        if id_commit.partition(':')[0] != 'HEAD':
+            self.ensure_full_history()
+        if ':' in id_commit:
+            # A tree in a commit, whose id git finds
+            tree_id = run_cmd(['git', 'rev-parse', '--verify', id_commit],
+                              cwd=self.path).strip()
+        else:
+            # The first header of a commit is 'tree <id>'
+            commit = self.cat_object(id_commit + '^{commit}', 'commit')
+            tree_id = commit[len(b'tree '):commit.index(b'\n')].decode()
+        yield from self.tree_items(tree_id, recursive)
+
+    def object_id_size(self):
+        """Return the size in bytes of the binary object ids of the repo
+        (20 for SHA-1, 32 for SHA-256)."""
+        if self._id_size is None:
+            object_format = run_cmd(['git', 'rev-parse',
+                                     '--show-object-format'],
+                                    cwd=self.path).strip()
+            self._id_size = 32 if object_format == 'sha256' else 20
+        return self._id_size
+
+    def tree_items(self, tree_id, recursive=False, prefix=''):
+        """Yield the (name, object id) of the entries of a tree, see
+        :py:func:`Repo.items`."""
+        entries = self._tree_cache.get(tree_id)
+        if entries is None:
+            entries = []
+            # Entries of '<mode> <name>\0<binary id>'
+            data = self.cat_object(tree_id, 'tree')
+            id_size = self.object_id_size()
+            start = 0
+            while start < len(data):
+                end = data.index(b'\0', start)
+                mode, name = data[start:end].split(b' ', 1)
+                entries.append((name.decode('utf-8'),
+                                data[end + 1:end + 1 + id_size].hex(),
+                                mode == b'40000'))
+                start = end + 1 + id_size
+            if len(self._tree_cache) >= TREE_CACHE_SIZE:
+                del self._tree_cache[next(iter(self._tree_cache))]
+            self._tree_cache[tree_id] = entries
+        for name, object_id, is_tree in entries:
+            if recursive and is_tree:
+                yield from self.tree_items(object_id, True,
+                                           prefix + name + '/')
+            else:
+                yield prefix + name, object_id
+
+    def list_files(self, id_commit='HEAD', recursive=False):
+        """List all files in repo in a commit, or in a directory of a
+        commit, see :py:func:`Repo.items`.
+
+        >>> import gitkv
+        >>> with gitkv.Repo() as repo:
+        ...     repo.os.makedirs('dir')
+        ...     with repo.open('dir/afile', 'w') as f:
+        ...         f.write('Some content')
+        ...     repo.git_commit()
+        12
+        >>> repo.list_files(), repo.list_files('HEAD:dir')
+        (['.gitignore', 'dir'], ['afile'])
+        """
+        return [name for name, _ in self.items(id_commit, recursive)]
 
     def __iter__(self):
         """Iterator over all the files in the last commit of the repo"""
-        return self.list_files().__iter__()
+        return iter(self.list_files())
 
     @staticmethod
-    def git_clone(url, path):
-        """Clone the remote repo at url in path."""
-        run_cmd(['git', 'clone', url, path])
+    def git_clone(url, path, *options):
+        """Clone the remote repo at url in path.
+
+        :param options: String array, will be passed as arguments to
+            `git clone`
+        """
+        run_cmd(['git'] + PARALLEL_CHECKOUT + ['clone'] + list(options)
+                + [url, path])
+
+    def ensure_full_history(self):
+        """Fetch the whole history if our clone is shallow.
+
+        This is called by all the methods that look at other commits than
+        HEAD, so users of shallow clones do not have to.
+
+        >>> import gitkv
+        >>> remote = gitkv.Repo()
+        >>> for content in ('First', 'Second'):
+        ...     with gitkv.open(remote.url, 'afile', 'w') as f:
+        ...         f.write(content)
+        5
+        6
+        >>> # git only makes shallow clones of urls, not of local paths
+        >>> repo = gitkv.Repo('file://' + remote.url)
+        >>> os.path.exists(repo.git_dir + 'shallow')
+        True
+        >>> repo.ensure_full_history()
+        >>> os.path.exists(repo.git_dir + 'shallow')
+        False
+        >>> with repo.open('afile') as f:
+        ...     [f.show_blob(c) for c in f.git_log()]
+        ['Second', 'First']
+        """
+        if os.path.exists(self.git_dir + 'shallow'):
+            run_cmd(['git', 'fetch', '--unshallow', '--no-tags', 'origin',
+                     self.branch], cwd=self.path)
 
     def git_push(self):
         """Push to remote repository."""
-        run_cmd(['git', 'push', 'origin', self.branch], cwd=self.path)
+        run_cmd(['git', 'push', '--porcelain', 'origin', self.branch],
+                cwd=self.path)
+        self.synced_head = self.head_id()
 
     def git_pull(self):
-        """Pull from remote repository."""
-        run_cmd(['git', 'pull', 'origin', self.branch], cwd=self.path)
+        """Pull from remote repository.
+
+        Only our branch is fetched, without tags. The pull always merges
+        (regardless of the user's ``pull.rebase`` setting), so that a
+        conflict leaves a merge in progress that can be resolved and
+        committed, see :py:func:`FileInRepo.git_log`. Unrelated histories
+        are merged: each clone of an empty remote makes its own initial
+        commit, so those of concurrent first writers have no common base.
+        """
+        try:
+            run_cmd(['git', 'pull', '--no-rebase', '--no-tags',
+                     '--allow-unrelated-histories', 'origin', self.branch],
+                    cwd=self.path)
+        finally:
+            # Even if the merge failed, the fetch told where the remote is
+            try:
+                with io.open(self.git_dir + 'FETCH_HEAD') as f:
+                    self.synced_head = f.read().split('\t', 1)[0] or None
+            except FileNotFoundError:
+                pass
 
     @staticmethod
     def git_init(path, bare=False):
@@ -281,55 +1229,330 @@ class Repo:
 
     def message(self, commit='HEAD'):
         """Return the commit message of the given commit."""
-        return '\n'.join(run_cmd(['git', 'rev-list', '--format=%B',
-                                  '--max-count=1',
-                                  commit], cwd=self.path
-                                 ).split('\n')[1:])
+        if commit != 'HEAD':
+            self.ensure_full_history()
+        # The message follows the headers and an empty line
+        message = self.cat_object(commit + '^{commit}',
+                                  'commit').split(b'\n\n', 1)[1]
+        return message.decode('utf-8') + '\n'
 
-    def git_commit(self, message=None):
-        """Create a commit."""
+    def commit_time(self, commit='HEAD'):
+        """Return the committer date of the given commit as a UNIX timestamp.
+
+        Git gives the timestamp as is, so no date string is parsed and the
+        result does not depend on the local timezone.
+
+        >>> import gitkv
+        >>> import time
+        >>> with gitkv.Repo() as repo:
+        ...     abs(repo.commit_time() - time.time()) < 60
+        True
+        """
+        if commit != 'HEAD':
+            self.ensure_full_history()
+        # 'committer <name> <<email>> <timestamp> <timezone>'
+        headers = self.cat_object(commit + '^{commit}',
+                                  'commit').split(b'\n\n', 1)[0]
+        for line in headers.split(b'\n'):
+            if line.startswith(b'committer '):
+                return int(line.split()[-2])
+
+    def git_commit(self, message=None, paths=None):
+        """Create a commit.
+
+        :param paths: the files to commit, by default those written since the
+            last commit (or everything, after a wrapped module call)."""
         if message is None:
             message = self.commit_message
-        run_cmd(['git', 'add', '.'], cwd=self.path)
+        with self.lock:
+            if paths is None:
+                paths = self._dirty
+            if paths and '.' not in paths:
+                # Only stat and hash the files we wrote, not the whole tree
+                run_cmds(['git', '--literal-pathspecs', 'add',
+                          '--pathspec-from-file=-', '--pathspec-file-nul'],
+                         commit_cmd(message),
+                         input='\0'.join(paths).encode('utf-8'),
+                         cwd=self.path)
+            else:
+                run_cmds(['git', 'add', '.'], commit_cmd(message),
+                         cwd=self.path)
+            if paths is self._dirty or '.' in paths:
+                self._dirty.clear()
+            else:
+                self._dirty.difference_update(paths)
+
+    def batch_message(self, paths=None):
+        """Return the message of the commit gathering our pending writes
+        (or the given paths).
+
+        Unless the user chose one, it tells how many files were written."""
+        if paths is None:
+            paths = self._dirty
+        if self.commit_message != 'GitKV' or '.' in paths or len(paths) < 2:
+            return self.commit_message
+        return 'GitKV: batch ({} files)'.format(len(paths))
+
+    def head_id(self):
+        """Return the id of the HEAD commit, None if there is none.
+
+        The refs are read in the git directory, without spawning git."""
         try:
-            run_cmd(['git', 'commit', '-m', message], cwd=self.path)
-        except:
-            pass
-
-    def git_log(self, *options, custom_filter=lambda c: True):
+            with io.open(self.git_dir + 'HEAD') as f:
+                head = f.read().strip()
+        except FileNotFoundError:
+            return None
+        if not head.startswith('ref: '):  # Detached HEAD
+            return head
+        return read_ref(self.git_dir, head[len('ref: '):])
+
+    def remote_head(self):
+        """Return the id of the commit the remote branch is at, None if there
+        is none.
+
+        The refs of a local remote are read in its directory, without
+        spawning git."""
+        ref = 'refs/heads/' + self.branch
+        if is_local_repo(self.url):
+            return read_ref(local_git_dir(self.url), ref)
+        output = run_cmd(['git', 'ls-remote', 'origin', ref], cwd=self.path)
+        return output.split('\t')[0] or None
+
+    def git_log(self, *options, custom_filter=lambda c: True, since=None,
+                until=None, message_contains=None):
         """Return the list of commits in reverse chronological order
 
         :param options: String array, will be passed as arguments to `git log`
         :param custom_filter: func, optional, filter commits according to an
              arbitrary criterion
+        :param since: int, optional, only list the commits made at or after
+             this UNIX timestamp. git stops walking the history as soon as it
+             reaches older commits, so this is cheaper than a custom_filter.
+        :param until: int, optional, only list the commits made at or before
+             this UNIX timestamp.
+        :param message_contains: str, optional, only list the commits whose
+             message contains this string. git matches it during its walk,
+             instead of a custom_filter reading each message afterwards.
         :return: list of commits,
 
+        The output of ``git log`` is cached until HEAD moves. Options
+        referring to other refs (e.g. ``--all``) are not tracked, and will
+        see the state they had when HEAD last moved.
+
+        >>> import gitkv
+        >>> with gitkv.Repo() as repo:
+        ...     for name in ('a', 'b'):
+        ...         with repo.open(name, 'w') as f:
+        ...             f.write(name)
+        ...         repo.git_commit('Write ' + name)
+        1
+        1
+        >>> [repo.message(c).strip()
+        ...  for c in repo.git_log(message_contains='Write')]
+        ['Write b', 'Write a']
+        >>> later = repo.commit_time() + 1
+        >>> len(repo.git_log(until=later)), repo.git_log(since=later)
+        (3, [])
+        """
+        # Before the options, which may end with paths
+        if message_contains is not None:
+            options = ('--fixed-strings',
+                       '--grep=' + message_contains) + options
+        if until is not None:
+            options = ('--until=@{}'.format(int(until)),) + options
+        if since is not None:
+            options = ('--since=@{}'.format(int(since)),) + options
+        self.ensure_full_history()
+        head = self.head_id()
+        commits = self._log_cache.get((head, options))
+        if commits is None:
+            # Only ask for the ids: no message bodies to transfer and parse,
+            # nor to be mistaken for a commit line
+            command = ['git', 'log', '--format=commit %H'] + list(options)
+            gitlog_process_output = run_cmd(command, cwd=self.path)
+            commits = COMMIT_LINE.findall(gitlog_process_output)
+            if head is not None:
+                self._log_cache = {k: v for k, v in self._log_cache.items()
+                                   if k[0] == head}
+                self._log_cache[(head, options)] = commits
+        return [c for c in commits if custom_filter(c)]
+
+    def iter_log(self, *options):
+        """Yield the ids of the commits listed by ``git log``, as git finds
+        them.
+
+        Unlike :py:func:`git_log`, nothing is cached, and git is stopped as
+        soon as the caller stops iterating, e.g. to only look at the most
+        recent commits of a long history.
+
+        :param options: String array, will be passed as arguments to `git log`
+
+        >>> import gitkv
+        >>> with gitkv.Repo() as repo:
+        ...     for i in range(3):
+        ...         with repo.open('afile', 'w') as f:
+        ...             f.write(str(i))
+        ...         repo.git_commit('Write {}'.format(i))
+        ...     repo.message(next(repo.iter_log())).strip()
+        1
+        1
+        1
+        'Write 2'
         """
-        command = ['git', 'log'] + list(options)
-        gitlog_process_output = run_cmd(command, cwd=self.path)
-        return [c for c in re.findall('(?<=commit )\w+',
-                                      gitlog_process_output)
-                if custom_filter(c)]
+        self.ensure_full_history()
+        command = ['git', 'log', '--format=%H'] + list(options)
+        with subprocess.Popen(command, cwd=self.path, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, close_fds=False,
+                              env=dict(os.environ, **GIT_ENV)) as process:
+            try:
+                for line in process.stdout:
+                    yield line.rstrip(b'\n').decode('ascii')
+            except GeneratorExit:
+                process.kill()
+                raise
+            error = process.stderr.read()
+        if process.returncode:
+            raise GitCmdError(command, process.returncode, error)
 
     def remote_sync(self):
-        """Create a commit of our changes and push it to the remote repo."""
-        # add a commit
-        self.git_commit()
-        # git push wen closing
+        """Create a commit of our changes and push it to the remote repo.
+
+        Nothing is pushed if no commit was made since we last fetched or
+        pushed. While the push is rejected because others pushed first, the
+        remote branch is merged in ours and the push tried again, up to
+        ``PUSH_ATTEMPTS`` times, after a random, exponentially growing wait.
+
+        :raise PushError: if the merge conflicts, or after the last attempt.
+        :raise GitCmdError: if the push failed for another reason.
+
+        >>> import gitkv
+        >>> repo = gitkv.Repo()
+        >>> # With a file:// url, git is asked to push without looking first
+        >>> url = 'file://' + repo.url
+        >>> repo_a, repo_b = gitkv.Repo(url), gitkv.Repo(url)
+        >>> with repo_a.open('a', 'w') as f:
+        ...     f.write('A')
+        1
+        >>> with repo_b.open('b', 'w') as f:
+        ...     f.write('B')
+        1
+        >>> repo_b.remote_sync()
+        >>> repo_a.remote_sync()  # Rejected, then merged and pushed again
+        >>> repo_a.close(); repo_b.close()
+        >>> with gitkv.Repo(url) as repo_c:
+        ...     sorted(repo_c)
+        ['.gitignore', 'a', 'b']
+        """
+        with self.lock:
+            open_files = {writer.filename for writer in list(self._writers)}
+            for name in sorted(open_files):
+                logger.warning('%s is still open, it is not committed', name)
+            if '.' not in self._dirty:
+                for name in self.changed_files() - self._dirty - open_files:
+                    logger.info('%s was changed outside of gitkv', name)
+                    self._dirty.add(name)
+            # add a commit, if anything was written
+            if self._dirty:
+                self.git_commit(self.batch_message())
+            # Even after a commit, which may have found nothing to commit
+            if self.head_id() == self.synced_head:
+                logger.debug('Nothing to push')
+                return
+            # The refs of a local remote are at hand: no need to try a push
+            # that we know would be rejected
+            if is_local_repo(self.url) \
+                    and self.remote_head() != self.synced_head:
+                self.pull_or_raise()
+            for attempt in range(PUSH_ATTEMPTS):
+                try:
+                    self.git_push()
+                    return
+                except GitCmdError as e:
+                    # Only a push rejected because the remote moved on is a
+                    # conflict, anything else (auth, network...) is not
+                    # retried
+                    if not is_rejected_push(e.output) and not (
+                            is_failed_ref_update(e.output)
+                            and self.remote_head() != self.synced_head):
+                        raise
+                if attempt + 1 < PUSH_ATTEMPTS:
+                    # Let the concurrent pushes that beat us go through
+                    time.sleep(random.uniform(0, PUSH_BACKOFF * 2 ** attempt))
+                    self.pull_or_raise()
+            raise PushError('Conflict when pushing')
+
+    def pull_or_raise(self):
+        """Merge the remote branch in ours, raise PushError on conflict."""
         try:
-            self.git_push()
-        # if confict
-        except RuntimeError:
-            try:
-                self.git_pull()
-                self.git_push()
-            except RuntimeError:
-                raise PushError('Conflict when pushing')
+            self.git_pull()
+        except GitCmdError:
+            raise PushError('Conflict when pushing')
 
     def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
-        """Exit a ``with`` block."""
+        """Exit a ``with`` block: commit and push, see
+        :py:func:`Repo.remote_sync`.
+
+        The Repo is not closed: it can still be read, see
+        :py:func:`Repo.close`.
+
+        With ``background_push``, the commit and push are made in a thread.
+        ``push_future.result()`` then waits for them and raises their error,
+        if any, e.g. a :py:class:`PushError`. An error nobody asks for is
+        only logged.
+
+        >>> import gitkv
+        >>> remote = gitkv.Repo()
+        >>> with gitkv.Repo(remote.url, background_push=True) as repo:
+        ...     with repo.open('afile', 'w') as f:
+        ...         f.write('Some content')
+        12
+        >>> repo.push_future.result()
+        >>> with gitkv.Repo(remote.url) as other:
+        ...     other.open('afile').read()
+        'Some content'
+        >>> sorted(repo), len(repo.git_log())
+        (['.gitignore', 'afile'], 2)
+        """
+        if self.background_push:
+            self.push_future = PUSH_EXECUTOR.submit(self.remote_sync)
+            # Nobody may ever ask the future for its error
+            self.push_future.add_done_callback(log_push_error)
+            return
         self.remote_sync()
 
+    def close_async(self, executor=PUSH_EXECUTOR):
+        """Run :py:func:`Repo.sync_and_close` in the background, return its
+        ``concurrent.futures.Future``, also kept as ``push_future``.
+
+        The Repo must not be used afterwards: its clone is only given back
+        once the future is done.
+
+        :param executor: where to run it, by default the threads of the
+            ``background_push`` of :py:func:`Repo.__exit__`.
+
+        >>> import gitkv
+        >>> repo = gitkv.Repo()
+        >>> with repo.open('afile', 'w') as f:
+        ...     f.write('Some content')
+        12
+        >>> repo.close_async().result()
+        >>> with gitkv.Repo(repo.url) as other:
+        ...     sorted(other)
+        ['.gitignore', 'afile']
+        """
+        self.push_future = executor.submit(self.sync_and_close)
+        return self.push_future
+
+    def sync_and_close(self):
+        """Call :py:func:`Repo.remote_sync`, then :py:func:`Repo.close`,
+        even if the former failed.
+
+        This is what closing a :py:class:`File` does with its Repo."""
+        try:
+            self.remote_sync()
+        finally:
+            self.close()
+
 
 class PushError(Exception):
     "Raised when gitkv can't push in a remote repository because a conflict."
@@ -340,47 +1563,65 @@ class ModuleWrapper:
     """Dynamically import a module and change the arguments of a function."""
     module_name = None
 
-    def __init__(self, item, arg_transform=lambda x: x):
+    def __init__(self, item, arg_transform=lambda x: x, module=None):
         """Return the wrapper
 
         :param module:string the name of a module to
             import or of a function to call
         :param arg_transform:func *args are passed through
             this function before being given to item if item is callable
+        :param module: the object to wrap, if already known, in which case
+            nothing is imported
         """
 
-        logger.debug("ModuleWrapper: " + item)
+        logger.debug("ModuleWrapper: %s", item)
         self.module_name = item
-        self.module = importlib.import_module(item)
+        # import_module takes the import lock even for imported modules
+        self.module = module if module is not None else \
+            sys.modules.get(item) or importlib.import_module(item)
         self.arg_transform = arg_transform
 
     def func_wrapper(self, func):
         """Return a wrapper over func that changes the arguments."""
-        logger.debug("ModuleWrapper({}).{}".format(
-            self.module_name,
-            func))
+        logger.debug("ModuleWrapper(%s).%s", self.module_name, func)
 
         def wrapped_func(*args, f=func,
                          ft=self.arg_transform, **kwargs):
             """Actually call f with modified arguments"""
-            logger.debug("ModuleWrapper({}).{}({})".format(
-                self.module_name,
-                func, *ft(*args)))
-            return f(*ft(*args), **kwargs)
+            args = ft(*args)
+            logger.debug("ModuleWrapper(%s).%s(%s)", self.module_name, func,
+                         args)
+            return f(*args, **kwargs)
 
         return wrapped_func
 
     def __getattr__(self, attr):
-        """Dynamically wrap a module or wrap a function"""
-        logger.debug("ModuleWrapper({}).gettattr({})".format(self.module_name,
-                                                             attr))
-        item_in_module = self.module.__getattribute__(attr)
-        logger.debug("ModuleWrapper: {}".format(item_in_module))
+        """Dynamically wrap a module or wrap a function
+
+        The wrapper is stored as an attribute of ours, so that the next
+        access to ``attr`` does not go through this method."""
+        logger.debug("ModuleWrapper(%s).gettattr(%s)", self.module_name, attr)
+        item_in_module = getattr(self.module, attr, _MISSING)
+        if item_in_module is _MISSING:
+            # A submodule not imported yet, e.g. xml.dom
+            name = '{}.{}'.format(self.module_name, attr)
+            try:
+                item_in_module = importlib.import_module(name)
+            except ModuleNotFoundError as e:
+                if e.name != name and not name.startswith(e.name + '.'):
+                    raise  # Something the submodule itself imports
+                raise AttributeError('{} has no attribute {}'.format(
+                    self.module_name, attr)) from None
+        logger.debug("ModuleWrapper: %s", item_in_module)
         if callable(item_in_module):
-            return self.func_wrapper(item_in_module)
+            wrapper = self.func_wrapper(item_in_module)
         else:
+            # The object is at hand, no need to import it by its name
             next_attribute_name = str(self.module_name) + '.' + attr
-            return ModuleWrapper(next_attribute_name, self.arg_transform)
+            wrapper = ModuleWrapper(next_attribute_name, self.arg_transform,
+                                    item_in_module)
+        self.__dict__[attr] = wrapper
+        return wrapper
 
 
 class FileInRepo:
@@ -411,6 +1652,13 @@ class FileInRepo:
     This mechanism works with any module, such as the csv module, for example.
     """
 
+    __slots__ = ('_attr_cache', 'commit_message', 'repo', 'filename', 'path',
+                 'mode', 'fd', '_stat', '_open_args',
+                 '__weakref__') + STREAM_METHODS
+
+    # Whether a file opened for reading only is opened on its first use
+    LAZY_READ = True
+
     def __enter__(self):
         """Start a ``with`` block."""
         return self
@@ -421,17 +1669,73 @@ class FileInRepo:
         This class should be instanciated with py:func:`gitkv.open` or
         py:func:`Repo.open`, and not directly.
         """
+        self._attr_cache = {}
         self.commit_message = 'GitKV: ' + filename
         self.repo = repo  # gitkv object
         self.filename = filename
-        self.fd = io.open(os.path.join(self.repo.path, self.filename),
-                          *args, **kwargs)
-        logger.debug('FileInRepo open ' + self.filename)
-
-    def show_blob(self, commit='HEAD'):
+        # Where our file is in the working tree, joined once for all
+        self.path = os.path.join(repo.path, filename)
+        self.mode = args[0] if args else kwargs.get('mode', 'r')
+        self._stat = None if is_read_only(self.mode) else self.stat()
+        if self._stat is not None \
+                and time.time_ns() - self._stat[2] < RACY_WINDOW:
+            self._stat = None  # Not to be trusted, see RACY_WINDOW
+        if not is_read_only(self.mode):
+            repo._writers.add(self)
+        self.fd = None
+        self._open_args = (args, kwargs)
+        if is_read_only(self.mode) and self.LAZY_READ:
+            # Only fail now, as open would, if there is nothing to read
+            if stat.S_ISDIR(os.stat(self.path).st_mode):
+                raise IsADirectoryError(errno.EISDIR,
+                                        os.strerror(errno.EISDIR), self.path)
+        else:
+            self.stream()
+        logger.debug('FileInRepo open %s', self.filename)
+
+    def stream(self):
+        """Return our stream object, opening it if this was not done yet.
+
+        Files opened for reading only are opened on their first use, so
+        that e.g. calling :py:func:`git_log` does not open them at all."""
+        if self.fd is None:
+            if self._open_args is None:
+                raise ValueError('I/O operation on closed file.')
+            args, kwargs = self._open_args
+            self.fd = self.open_stream(*args, **kwargs)
+            for name in STREAM_METHODS:
+                setattr(self, name, getattr(self.fd, name))
+        return self.fd
+
+    def stat(self):
+        """Return what tells whether our file in the working tree changed,
+        None if it does not exist."""
+        try:
+            s = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return s.st_ino, s.st_size, s.st_mtime_ns, s.st_ctime_ns
+
+    def open_stream(self, mode='r', buffering=-1, encoding=None,
+                    errors=None, newline=None, closefd=True, opener=None):
+        """Return the stream object of our file in the working tree.
+
+        Binary writes get a larger buffer, so that loops of small writes
+        (use mode ``'wb'`` for those) hit the disk less often. Text is UTF-8
+        unless told otherwise, like what :py:func:`show_blob` returns."""
+        if buffering == -1 and 'b' in mode and not is_read_only(mode):
+            buffering = WRITE_BUFFER_SIZE
+        if encoding is None and 'b' not in mode:
+            encoding = 'utf-8'
+        return io.open(self.path, mode, buffering, encoding, errors, newline,
+                       closefd, opener)
+
+    def show_blob(self, commit='HEAD', binary=False):
         """Return the contents of self at a commit
 
         :param id_commit: type str, commit hex.
+        :param binary: bool, optional, return the raw bytes instead of
+            decoding them, e.g. when comparing versions or hashing them
         :return: this file's data
 
 
@@ -449,19 +1753,24 @@ class FileInRepo:
         >>> with repo.open('dossier/afile') as f:
         ...     for cid in f.git_log():
         ...         print(f.show_blob(cid))
+        ...     f.show_blob(binary=True)
         Edit
         Initial
-
+        b'Edit'
         """
-        return run_cmd(['git', 'cat-file', 'blob',
-                        '{}:{}'.format(commit, self.filename)],
-                       cwd=self.repo.path)
+        if commit != 'HEAD':
+            self.repo.ensure_full_history()
+        data = self.repo.cat_blob('{}:{}'.format(commit, self.filename))
+        return data if binary else data.decode('utf-8')
 
-    def git_log(self, *options):
+    def git_log(self, *options, since=None, until=None,
+                message_contains=None):
         """Return a list of all commits that modified this instance's file,
         sorted from most recent to most ancient.
 
         :param options: String array, will be passed as arguments to `git log`
+        :param since until message_contains: optional, see
+            :py:func:`Repo.git_log`
 
         :return: list of commits.
 
@@ -526,7 +1835,14 @@ class FileInRepo:
         ...     [f.repo.message(c).strip() for c in f.git_log('--date-order')]
         ['Merge', 'A write', 'B write', 'Create myfile']
         """
-        return self.repo.git_log(*(list(options) + [self.filename]))
+        return self.repo.git_log(*(list(options) + ['--', self.filename]),
+                                 since=since, until=until,
+                                 message_contains=message_contains)
+
+    def iter_log(self, *options):
+        """Yield the commits that modified this instance's file, see
+        :py:func:`Repo.iter_log`."""
+        return self.repo.iter_log(*(list(options) + ['--', self.filename]))
 
     def git_commit(self, message=None):
         """ Create a commit
@@ -534,18 +1850,11 @@ class FileInRepo:
         # commentaire = '"' + message + '"'
         if message is None:
             message = self.commit_message
-        logger.debug('From gitkv : Commit file ' + self.filename)
-        # git add .
-        run_cmd(['git', 'add', self.filename], cwd=self.repo.path)
-        # git commit
-        try:
-            output = subprocess.check_output(
-                ['git', 'commit', '-m', message],
-                cwd=self.repo.path)
-            logger.debug('{}\n\t{}'.format('git commit:\n\t',
-                                           output))
-        except subprocess.CalledProcessError as e:
-            logger.debug(e.output)
+        logger.debug('From gitkv : Commit file %s', self.filename)
+        with self.repo.lock:
+            run_cmds(['git', '--literal-pathspecs', 'add', '--',
+                      self.filename], commit_cmd(message),
+                     cwd=self.repo.path)
 
     def __iter__(self):
         """Explicitely delegate __iter__ to our real file descriptor.
@@ -553,26 +1862,65 @@ class FileInRepo:
         Our __getattr__ trickery can not handle dunder methods, we need
         to explicietly pass the call.
         https://bugs.python.org/issue30352"""
-        return self.fd.__iter__()
+        return self.stream().__iter__()
 
     def __getattr__(self, item):
-        """Search attribute not defined in this class"""
-        try:
-            return self.__getattribute__(item)
-        except AttributeError:
-            try:
-                return self.fd.__getattribute__(item)
-            except AttributeError:
-
-                def add_stream_as_last_arg(*args):
-                    return list(args) + [self.fd]
-
-                return ModuleWrapper(item, add_stream_as_last_arg)
+        """Search attribute not defined in this class
+
+        The methods of our stream and the ``ModuleWrapper`` are cached, so
+        that e.g. ``f.flush`` in a loop only resolves once. Other attributes
+        of the stream (e.g. ``closed``) may change, they are not cached."""
+        if item in self._attr_cache:
+            return self._attr_cache[item]
+        if item in STREAM_METHODS:  # Not bound yet, as we are not open yet
+            self.stream()
+            return getattr(self, item)
+        value = getattr(self.stream(), item, _MISSING)
+        if value is not _MISSING and not callable(value):
+            return value
+        if value is _MISSING:
+
+            def add_stream_as_last_arg(*args):
+                return list(args) + [self.stream()]
+
+            value = ModuleWrapper(item, add_stream_as_last_arg)
+        self._attr_cache[item] = value
+        return value
 
     def close(self):
         """Close the stream object
+
+        If it was opened for writing, the file is committed by the repo
+        (see :py:class:`Repo`), or right now if its ``commit_per_file``
+        attribute is True.
         """
-        self.fd.close()
+        if self.fd is not None:
+            self.fd.close()
+        self._open_args = None
+        if is_read_only(self.mode):
+            return
+        self.repo._writers.discard(self)
+        if self._stat is not None and self._stat == self.stat():
+            logger.debug('%s is unchanged', self.filename)
+            return
+        batch = getattr(self.repo._batch, 'files', None)
+        if batch is not None:
+            batch.add(self.filename)
+        elif self.repo.commit_per_file:
+            self.git_commit()
+        else:
+            with self.repo.lock:
+                self.repo._dirty.add(self.filename)
+
+    def abort(self):
+        """Close the stream object, without committing the file.
+
+        The file stays as it is in the working tree, see
+        :py:func:`Repo.abort` to drop it."""
+        if self.fd is not None:
+            self.fd.close()
+        self._open_args = None
+        self.repo._writers.discard(self)
 
     def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
         """Exit a ``with`` block."""
@@ -580,6 +1928,78 @@ class FileInRepo:
         self.close()
 
 
+class ReadOnlyRepo(Repo):
+    """A local git repository, read in place at its HEAD.
+
+    No clone is made, and nothing is ever committed or pushed. It is used
+    by :py:class:`File` for the files that are only read.
+    """
+
+    def __init__(self, url):
+        """Return the context manager.
+
+        :param url: path of a local git repository, bare or not.
+        """
+        self.init_state(url)
+        self.path = os.path.join(url, '')
+        self.git_dir = (self.path if os.path.isfile(self.path + 'HEAD')
+                        else self.path + '.git' + os.sep)
+
+    def open(self, filename, *args, **kwargs):
+        """Open a file in this Repo, for reading only.
+
+        See :py:func:`Repo.open`.
+        """
+        logger.debug('Opening file %s at HEAD', filename)
+        return BlobInRepo(filename, self, *args, **kwargs)
+
+    def git_commit(self, message=None):
+        """Do nothing, a read only repo has nothing to commit."""
+
+    def ensure_full_history(self):
+        """Do nothing, we must not fetch into the user's repo."""
+
+    def refresh(self):
+        """Do nothing, we always read the current HEAD of the user's repo."""
+
+    def remote_sync(self):
+        """Do nothing, a read only repo has nothing to push."""
+
+    def close(self):
+        """Stop our ``git cat-file`` process, there is no clone to give back.
+        """
+        if self._cat_file is not None:
+            self._cat_file[1]()
+            self._cat_file = None
+
+
+class BlobInRepo(FileInRepo):
+    """A file of a :py:class:`ReadOnlyRepo`, read from its HEAD commit."""
+
+    __slots__ = ()
+
+    # Whether the file exists is only known by reading it
+    LAZY_READ = False
+
+    def open_stream(self, mode='r', buffering=-1, encoding=None,
+                    errors=None, newline=None):
+        """Return an in-memory stream over the file's content at HEAD.
+
+        :raise FileNotFoundError: if the file is not in the HEAD commit."""
+        try:
+            data = self.repo.cat_blob('HEAD:' + self.filename)
+        except RuntimeError:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    self.filename)
+        stream = io.BytesIO(data)
+        if 'b' in mode:
+            return stream
+        return io.TextIOWrapper(stream, encoding or 'utf-8', errors, newline)
+
+    def git_commit(self, message=None):
+        """Do nothing, a read only file has nothing to commit."""
+
+
 if __name__ == "__main__":
     import doctest
 
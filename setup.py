@@ -18,7 +18,10 @@ setup(
     license='AGPLv3',
     classifiers=[
         'Programming Language :: Python :: 3',
+        'Operating System :: POSIX',
     ],
+    # Clones are locked with flock, and git commands are chained in sh
+    platforms=['POSIX'],
     keywords='gitkv use a git repo as a key-value store.',
     packages=['gitkv'],
     include_package_data=True,